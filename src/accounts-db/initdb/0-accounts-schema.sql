@@ -42,4 +42,5 @@ CREATE TABLE IF NOT EXISTS contacts (
   FOREIGN KEY (username) REFERENCES users(username)
 );
 
-CREATE INDEX IF NOT EXISTS idx_contacts_username ON contacts (username);
+CREATE INDEX IF NOT EXISTS idx_contacts_username_account ON contacts (username, account_num, routing_num);
+CREATE INDEX IF NOT EXISTS idx_contacts_username_label ON contacts (username, label);
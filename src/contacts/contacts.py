@@ -18,19 +18,40 @@ Manages internal user contacts and external accounts.
 """
 
 import atexit
+import hashlib
 import logging
 import os
 import re
 import sys
+import threading
+import time
 
-from flask import Flask, jsonify, request
-import bleach
+from cachetools import TTLCache
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from flask import Flask, request
 import jwt
+import orjson
 from sqlalchemy import create_engine, MetaData, Table, Column, String, Boolean
+from sqlalchemy import and_, or_, bindparam, literal, select
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.util import LRUCache
 
 APP = Flask(__name__)
 
+# pre-encoded bodies of constant JSON responses
+EMPTY_JSON = orjson.dumps({})
+AUTH_DENIED_JSON = orjson.dumps({'msg': 'authentication denied'})
+GET_FAILED_JSON = orjson.dumps({'msg': 'failed to retrieve contacts list'})
+ADD_FAILED_JSON = orjson.dumps({'msg': 'failed to add contact'})
+# fields accepted when creating a new contact
+CONTACT_FIELDS = ('label',
+                  'account_num',
+                  'routing_num',
+                  'is_external')
+# pattern for validating new contact labels
+LABEL_RE = re.compile(r'^[0-9a-zA-Z][0-9a-zA-Z ]{0,29}$')
+
 @APP.route('/version', methods=['GET'])
 def version():
     """
@@ -52,22 +73,18 @@ def get_contacts(username):
 
     Return: a list of contacts
     """
-    auth_header = request.headers.get('Authorization')
-    if auth_header:
-        token = auth_header.split(" ")[-1]
-    else:
-        token = ''
+    token = _get_bearer_token(request.headers.get('Authorization'))
     try:
-        auth_payload = jwt.decode(token, key=APP.config['PUBLIC_KEY'], algorithms='RS256')
+        auth_payload = _verify_token(token)
         if username != auth_payload['user']:
             raise PermissionError
-        contacts_list = _get_contacts(username)
-        return jsonify(contacts_list), 200
+        contacts_json = _get_contacts_json(username)
+        return _json_response(contacts_json, 200)
     except (PermissionError, jwt.exceptions.InvalidTokenError):
-        return jsonify({'msg': 'authentication denied'}), 401
+        return _json_response(AUTH_DENIED_JSON, 401)
     except SQLAlchemyError as err:
         APP.logger.error(err)
-        return jsonify({'msg': 'failed to retrieve contacts list'}), 500
+        return _json_response(GET_FAILED_JSON, 500)
 
 
 @APP.route('/contacts/<username>', methods=['POST'])
@@ -83,77 +100,138 @@ def add_contact(username):
     - label
     - is_external
     """
-    auth_header = request.headers.get('Authorization')
-    if auth_header:
-        token = auth_header.split(" ")[-1]
-    else:
-        token = ''
+    token = _get_bearer_token(request.headers.get('Authorization'))
     try:
-        auth_payload = jwt.decode(token, key=APP.config['PUBLIC_KEY'], algorithms='RS256')
+        auth_payload = _verify_token(token)
         if username != auth_payload['user']:
             raise PermissionError
 
-        req = {k: (bleach.clean(v) if isinstance(v, str) else v)
-               for k, v in request.get_json().items()}
+        # label is restricted to alphanumerics and spaces by validation,
+        # so none of the fields need HTML sanitization
+        body = request.get_json() or {}
+        req = {f: body[f] for f in CONTACT_FIELDS if f in body}
         _validate_new_contact(req)
 
         _check_contact_allowed(username, auth_payload['acct'], req)
 
         _add_contact(username, req)
-        return jsonify({}), 201
+        return _json_response(EMPTY_JSON, 201)
 
     except (PermissionError, jwt.exceptions.InvalidTokenError):
-        return jsonify({'msg': 'authentication denied'}), 401
+        return _json_response(AUTH_DENIED_JSON, 401)
     except UserWarning as warn:
-        return jsonify({'msg': str(warn)}), 400
+        return _json_response(orjson.dumps({'msg': str(warn)}), 400)
     except ValueError as err:
-        return jsonify({'msg': str(err)}), 409
+        return _json_response(orjson.dumps({'msg': str(err)}), 409)
     except SQLAlchemyError as err:
         APP.logger.error(err)
-        return jsonify({'msg': 'failed to add contact'}), 500
+        return _json_response(ADD_FAILED_JSON, 500)
+
+
+def _json_response(body, status):
+    """Build a response from an already encoded JSON body"""
+    return APP.response_class(body, status=status, mimetype='application/json')
+
+
+def _get_bearer_token(auth_header):
+    """Extract the token from a 'Bearer <token>' Authorization header.
+
+    Return: the encoded token, or '' if the header is missing or not a bearer token
+    """
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header[7:]
+    return ''
+
+
+def _verify_token(token):
+    """Decode and verify a JWT, reusing previously verified payloads.
+
+    Verified payloads are cached under a truncated hash of the token until
+    the cache TTL or the token's own expiry, whichever comes first.
+    Invalid tokens are never cached.
+
+    Params: token - the encoded bearer token
+    Return: the decoded token payload
+    Raises: jwt.exceptions.InvalidTokenError if the token is invalid
+    """
+    token_hash = hashlib.sha256(token.encode()).digest()[:16]
+    with TOKEN_CACHE_LOCK:
+        payload = TOKEN_CACHE.get(token_hash)
+        if payload is not None:
+            if payload['exp'] > time.time():
+                return payload
+            del TOKEN_CACHE[token_hash]
+
+    payload = jwt.decode(token, key=APP.config['PUBLIC_KEY'], algorithms='RS256')
+    # only tokens that expire can safely be reused
+    if 'exp' in payload:
+        with TOKEN_CACHE_LOCK:
+            TOKEN_CACHE[token_hash] = payload
+    return payload
 
 
 def _validate_new_contact(req):
     """Check that this new contact request has valid fields"""
-    APP.logger.debug('validating add contact request: %s', str(req))
+    APP.logger.debug('validating add contact request: %s', req)
     # Check if required fields are filled
-    fields = ('label',
-              'account_num',
-              'routing_num',
-              'is_external')
-    if any(f not in req for f in fields):
+    if any(f not in req for f in CONTACT_FIELDS):
         raise UserWarning('missing required field(s)')
 
     # Validate account number (must be 10 digits)
-    if not re.match(r'\A[0-9]{10}\Z', req['account_num']):
+    if not _is_ascii_digits(req['account_num'], 10):
         raise UserWarning('invalid account number')
     # Validate routing number (must be 9 digits)
-    if not re.match(r'\A[0-9]{9}\Z', req['routing_num']):
+    if not _is_ascii_digits(req['routing_num'], 9):
         raise UserWarning('invalid routing number')
     # Only allow external accounts to deposit
     if req['is_external'] and req['routing_num'] == APP.config['LOCAL_ROUTING']:
         raise UserWarning('invalid routing number')
     # Validate label
     # Must be >0 and <30 chars, alphanumeric and spaces, can't start with space
-    if not re.match(r'^[0-9a-zA-Z][0-9a-zA-Z ]{0,29}$', req['label']):
+    if not LABEL_RE.match(req['label']):
         raise UserWarning('invalid account label')
 
 
+def _is_ascii_digits(value, length):
+    """Check that value is a string of exactly length ASCII digits"""
+    return (isinstance(value, str) and len(value) == length
+            and value.isascii() and value.isdigit())
+
+
 def _check_contact_allowed(username, accountid, req):
-    """Check that this contact is allowed to be created"""
+    """Check that this contact is allowed to be created
+
+    Expects a request that already passed _validate_new_contact; checks
+    that need no database access run before the duplicate contact query.
+    """
     # Don't allow self reference
     if (req['account_num'] == accountid and
             req['routing_num'] == APP.config['LOCAL_ROUTING']):
         raise ValueError('may not add yourself to contacts')
 
     # Don't allow identical contacts
-    for contact in _get_contacts(username):
-        if (contact['account_num'] == req['account_num'] and
-                contact['routing_num'] == req['routing_num']):
+    params = {'username': username,
+              'label': req['label'],
+              'account_num': req['account_num'],
+              'routing_num': req['routing_num']}
+    if _contact_exists(DUPLICATE_CONTACT_STMT, params):
+        # only probe again to report which constraint was violated
+        if _contact_exists(DUPLICATE_ACCOUNT_STMT, params):
             raise ValueError('account already exists as a contact')
+        raise ValueError('contact already exists with that label')
 
-        if contact['label'] == req['label']:
-            raise ValueError('contact already exists with that label')
+
+def _contact_exists(statement, params):
+    """Check if an existence query over the contacts table matches any row.
+
+    Params: statement - a prepared SELECT 1 ... LIMIT 1 statement
+            params - a key/value dict of bind parameters for the statement
+    Return: True if at least one matching contact exists
+    Raises: SQLAlchemyError if there was an issue with the database
+    """
+    APP.logger.debug('QUERY: %s', statement)
+    with ACCOUNTS_DB.connect() as conn:
+        return conn.execute(statement, params).first() is not None
 
 
 def _add_contact(username, contact):
@@ -169,33 +247,42 @@ def _add_contact(username, contact):
             'account_num': contact['account_num'],
             'routing_num': contact['routing_num'],
             'is_external': contact['is_external']}
-    statement = CONTACTS_TABLE.insert().values(data)
-    APP.logger.debug('QUERY: %s', str(statement))
-    DB_CONN.execute(statement)
+    APP.logger.debug('QUERY: %s', ADD_CONTACT_STMT)
+    with ACCOUNTS_DB.connect() as conn:
+        conn.execute(ADD_CONTACT_STMT, data)
+    with CONTACTS_CACHE_LOCK:
+        CONTACTS_GENERATIONS[username] = CONTACTS_GENERATIONS.get(username, 0) + 1
+        CONTACTS_CACHE.pop(username, None)
 
 
-def _get_contacts(username):
-    """Get a list of contacts for the specified username.
+def _get_contacts_json(username):
+    """Get the JSON encoded list of contacts for the specified username.
 
     Params: username - the username of the user
-    Return: a list of contacts in the form of key/value attribute dicts,
-            [ {'label': contact1, ...}, {'label': contact2, ...}, ...]
+    Return: a JSON array of contacts in the form of key/value attribute objects,
+            b'[{"label": contact1, ...}, {"label": contact2, ...}, ...]'
     Raises: SQLAlchemyError if there was an issue with the database
-    """
-    contacts = list()
-    statement = CONTACTS_TABLE.select().where(
-        CONTACTS_TABLE.c.username == username)
-    APP.logger.debug('QUERY: %s', str(statement))
-    result = DB_CONN.execute(statement)
-    APP.logger.debug('RESULT: %s', str(result))
-    for row in result:
-        contact = {
-            'label': row['label'],
-            'account_num': row['account_num'],
-            'routing_num': row['routing_num'],
-            'is_external': row['is_external']}
-        contacts.append(contact)
 
+    The fetched list is encoded to JSON once and cached as bytes, briefly,
+    per username; adding a contact through this process invalidates that
+    user's entry.
+    """
+    with CONTACTS_CACHE_LOCK:
+        contacts = CONTACTS_CACHE.get(username)
+        generation = CONTACTS_GENERATIONS.get(username, 0)
+    if contacts is not None:
+        return contacts
+
+    APP.logger.debug('QUERY: %s', GET_CONTACTS_STMT)
+    with ACCOUNTS_DB.connect() as conn:
+        result = conn.execute(GET_CONTACTS_STMT, {'username': username})
+        APP.logger.debug('RESULT: %s', result)
+        # plain str keys: orjson rejects the quoted_name keys of dict(row)
+        contacts = orjson.dumps([{f: row[f] for f in CONTACT_FIELDS} for row in result])
+    with CONTACTS_CACHE_LOCK:
+        # don't cache a result read before a concurrently added contact
+        if CONTACTS_GENERATIONS.get(username, 0) == generation:
+            CONTACTS_CACHE[username] = contacts
     return contacts
 
 
@@ -203,9 +290,9 @@ def _get_contacts(username):
 def _shutdown():
     """Executed when web app is terminated."""
     try:
-        DB_CONN.close()
+        ACCOUNTS_DB.dispose()
     except NameError:
-        # catch name error when DB_CONN not set up
+        # catch name error when ACCOUNTS_DB not set up
         pass
     APP.logger.info("Stopping flask.")
 
@@ -216,18 +303,51 @@ APP.logger.setLevel(logging.getLogger('gunicorn.error').level)
 # setup global variables
 APP.config['VERSION'] = os.environ.get('VERSION')
 APP.config['LOCAL_ROUTING'] = os.environ.get('LOCAL_ROUTING_NUM')
-APP.config['PUBLIC_KEY'] = open(os.environ.get('PUB_KEY_PATH'), 'r').read()
+# parse the PEM once so token verification can use the key object directly
+APP.config['PUBLIC_KEY'] = load_pem_public_key(
+    open(os.environ.get('PUB_KEY_PATH'), 'rb').read(), backend=default_backend())
+
+# cache of verified JWT payloads, keyed by token hash
+TOKEN_CACHE = TTLCache(maxsize=10000, ttl=60)
+TOKEN_CACHE_LOCK = threading.Lock()
+# short-lived cache of JSON encoded contacts lists, keyed by username
+CONTACTS_CACHE = TTLCache(maxsize=2048, ttl=10)
+# number of contacts added per username, bumped on every insert
+CONTACTS_GENERATIONS = {}
+CONTACTS_CACHE_LOCK = threading.Lock()
 
 # Configure database connection
 try:
-    ACCOUNTS_DB = create_engine(os.environ.get('ACCOUNTS_DB_URI'))
+    # each query checks out its own pooled connection; the default pool of
+    # 5 connections covers the 4 gunicorn threads set in the Dockerfile.
+    # reuse the compiled SQL of the prepared statements below across requests
+    ACCOUNTS_DB = create_engine(os.environ.get('ACCOUNTS_DB_URI')).execution_options(
+        compiled_cache=LRUCache(1200))
     CONTACTS_TABLE = Table('contacts', MetaData(ACCOUNTS_DB),
                            Column('username', String),
                            Column('label', String),
                            Column('account_num', String),
                            Column('routing_num', String),
                            Column('is_external', Boolean))
-    DB_CONN = ACCOUNTS_DB.connect()
+
+    # prepared statements, parameterized with bind parameters at execution
+    ADD_CONTACT_STMT = CONTACTS_TABLE.insert()
+    GET_CONTACTS_STMT = select([CONTACTS_TABLE.c.label,
+                                CONTACTS_TABLE.c.account_num,
+                                CONTACTS_TABLE.c.routing_num,
+                                CONTACTS_TABLE.c.is_external]).where(
+                                    CONTACTS_TABLE.c.username == bindparam('username'))
+    _SAME_USER = CONTACTS_TABLE.c.username == bindparam('username')
+    _SAME_ACCOUNT = and_(CONTACTS_TABLE.c.account_num == bindparam('account_num'),
+                         CONTACTS_TABLE.c.routing_num == bindparam('routing_num'))
+    _SAME_LABEL = CONTACTS_TABLE.c.label == bindparam('label')
+    DUPLICATE_CONTACT_STMT = select([literal(1)]).select_from(CONTACTS_TABLE).where(
+        and_(_SAME_USER, or_(_SAME_ACCOUNT, _SAME_LABEL))).limit(1)
+    DUPLICATE_ACCOUNT_STMT = select([literal(1)]).select_from(CONTACTS_TABLE).where(
+        and_(_SAME_USER, _SAME_ACCOUNT)).limit(1)
+
+    # fail fast if the database is unreachable
+    ACCOUNTS_DB.connect().close()
 except OperationalError:
     APP.logger.critical("database connection failed")
     sys.exit(1)
@@ -0,0 +1,150 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for contacts
+"""
+
+from datetime import datetime, timedelta
+import importlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+import jwt
+
+EXAMPLE_CONTACT = {
+    'label': 'Alice',
+    'account_num': '1234567890',
+    'routing_num': '111111111',
+    'is_external': True,
+}
+
+
+class TestContacts(unittest.TestCase):
+    """
+    Test cases for contacts
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Generate a JWT signing key pair shared by all tests"""
+        cls.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        public_pem = cls.private_key.public_key().public_bytes(
+            Encoding.PEM, PublicFormat.SubjectPublicKeyInfo)
+        with tempfile.NamedTemporaryFile(delete=False) as key_file:
+            key_file.write(public_pem)
+        cls.public_key_path = key_file.name
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove the public key file"""
+        os.remove(cls.public_key_path)
+
+    def setUp(self):
+        """Load contacts against a fresh sqlite in mem database"""
+        env = {
+            'VERSION': '1',
+            'LOCAL_ROUTING_NUM': '123456789',
+            'PUB_KEY_PATH': self.public_key_path,
+            'ACCOUNTS_DB_URI': 'sqlite:///:memory:',
+        }
+        with patch.dict('os.environ', env):
+            # reload to rebuild the module level engine, caches and config
+            from contacts import contacts
+            self.contacts = importlib.reload(contacts)
+        self.contacts.CONTACTS_TABLE.create(self.contacts.ACCOUNTS_DB)
+        self.test_app = self.contacts.APP.test_client()
+
+    def _auth_header(self, username='foo', acct='0000000001'):
+        """Build an Authorization header with a valid token for username"""
+        payload = {
+            'user': username,
+            'acct': acct,
+            'exp': datetime.utcnow() + timedelta(minutes=5),
+        }
+        token = jwt.encode(payload, self.private_key, algorithm='RS256')
+        return {'Authorization': 'Bearer ' + token.decode('utf-8')}
+
+    def test_get_contacts_empty_list_200_status_code(self):
+        """test getting contacts for a user without any"""
+        response = self.test_app.get('/contacts/foo', headers=self._auth_header())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), [])
+
+    def test_get_contacts_after_add_contact_returns_contact(self):
+        """test getting contacts after a contact was added"""
+        headers = self._auth_header()
+        # populate the contacts cache before adding
+        self.test_app.get('/contacts/foo', headers=headers)
+
+        response = self.test_app.post(
+            '/contacts/foo', json=EXAMPLE_CONTACT, headers=headers)
+        self.assertEqual(response.status_code, 201)
+
+        response = self.test_app.get('/contacts/foo', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), [EXAMPLE_CONTACT])
+
+    def test_add_duplicate_contact_409_status_code(self):
+        """test adding the same contact twice"""
+        headers = self._auth_header()
+        self.test_app.post('/contacts/foo', json=EXAMPLE_CONTACT, headers=headers)
+
+        response = self.test_app.post(
+            '/contacts/foo', json=EXAMPLE_CONTACT, headers=headers)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['msg'], 'account already exists as a contact')
+
+    def test_get_contacts_invalid_token_401_status_code(self):
+        """test getting contacts with an invalid token"""
+        response = self.test_app.get(
+            '/contacts/foo', headers={'Authorization': 'Bearer invalid'})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.get_json(), {'msg': 'authentication denied'})
+
+    def test_get_contacts_concurrent_add_contact_not_cached(self):
+        """test a list read before a concurrent add is not cached"""
+        headers = self._auth_header()
+        test_app = self.test_app
+        original_connect = self.contacts.ACCOUNTS_DB.connect
+
+        class ConnectionAddingContact:
+            """Connection that adds a contact right after reading the list"""
+            def __enter__(self):
+                self.conn = original_connect()
+                return self
+
+            def __exit__(self, *args):
+                self.conn.close()
+
+            def execute(self, *args):
+                """Read all rows, then add a contact as another thread would"""
+                rows = list(self.conn.execute(*args))
+                patcher.stop()
+                test_app.post('/contacts/foo', json=EXAMPLE_CONTACT, headers=headers)
+                return rows
+
+        patcher = patch.object(self.contacts.ACCOUNTS_DB, 'connect',
+                               side_effect=ConnectionAddingContact)
+        patcher.start()
+        self.assertEqual(test_app.get('/contacts/foo', headers=headers).get_json(), [])
+
+        response = test_app.get('/contacts/foo', headers=headers)
+        self.assertEqual(response.get_json(), [EXAMPLE_CONTACT])